@@ -12,17 +12,29 @@ Dépendances minimales :
     pip install streamlit jinja2 reportlab
 Optionnel (PDF plus joli) :
     pip install weasyprint
+Optionnel (liaison des médias plus rapide sur les grosses discussions) :
+    pip install pyahocorasick
 """
 import base64
 import datetime as dt
-import io
+import hashlib
+import heapq
+import html
+import operator
+import os
 import re
+import sys
 import zipfile
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple
 
 import streamlit as st
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # --- Page setup
 st.set_page_config(page_title="WhatsApp Viewer — Pour Manon", layout="wide", page_icon="💚")
 
@@ -74,6 +86,7 @@ MEDIA_EXTS = {
     "doc": {".pdf", ".txt", ".vcf", ".csv", ".doc", ".docx", ".xls", ".xlsx", ".zip"}
 }
 ALL_MEDIA_EXTS = set().union(*MEDIA_EXTS.values())
+_EXT_TO_KIND = {ext: kind for kind, exts in MEDIA_EXTS.items() for ext in exts}
 
 # Formats de ligne reconnus (crochets / sans virgule / AM-PM / secondes optionnelles / espaces avant ':')
 DATE_TIME_PATTERNS = [
@@ -89,20 +102,39 @@ DATE_TIME_PATTERNS = [
     (re.compile(r"^(\d{1,2}[\/\.\-]\d{1,2}[\/\.\-]\d{2,4})\s+(\d{1,2}:\d{2}:\d{2})\s+([^:]+?)\s*:\s(.*)$"), "%d/%m/%Y %H:%M:%S"),
 ]
 
+# Les formats ci-dessus fusionnés en une seule alternance : une ligne = un seul passage regex.
+# Chaque branche est enveloppée dans un groupe nommé f<i> ; m.lastindex pointe sur ce groupe
+# et les 4 groupes suivants sont (date, heure, auteur, texte).
+# NB : moteur re standard volontairement. google-re2 donne les mêmes résultats mais mesuré
+# ~20x plus lent par ligne (surcoût du wrapper Python sur des chaînes courtes) ; le filtre
+# de premier caractère et la regex spécialisée comptent bien plus que le moteur.
+LINE_RE = re.compile("|".join(f"(?P<f{i}>{pat.pattern[1:]})" for i, (pat, _fmt) in enumerate(DATE_TIME_PATTERNS)))
+# Format indicatif de chaque branche, indexé par m.lastindex (passé à parse_datetime)
+LINE_FMTS = {LINE_RE.groupindex[f"f{i}"]: fmt for i, (_pat, fmt) in enumerate(DATE_TIME_PATTERNS)}
+
 MEDIA_OMITTED_TOKENS = {"<Media omitted>", "<Média omis>", "<Média omise>", "image omitted", "video omitted", "image omise", "video omise"}
 
-def classify_ext(path: Path) -> str:
-    ext = path.suffix.lower()
-    for kind, exts in MEDIA_EXTS.items():
-        if ext in exts:
-            return kind
-    return "doc"
+# Regex compilées une seule fois au chargement du module
+_TITLE_PREFIX_RES = (
+    re.compile(r"^WhatsApp Chat with\s+", re.IGNORECASE),
+    re.compile(r"^Discussion WhatsApp avec\s+", re.IGNORECASE),
+)
+_SLUG_RE = re.compile(r"[^a-zA-Z0-9_-]+")
+# Regex sûre (pas de 'bad character range') : nom de fichier à extension média connue,
+# ou nom WhatsApp ...-YYYYMMDD-WA1234.ext quelle que soit l'extension. Un seul finditer par message.
+_ATTACH_RE = re.compile(
+    r"([\w.\-]+\.(?:jpg|jpeg|png|gif|mp4|3gp|mov|avi|mkv|m4v|opus|ogg|mp3|wav|m4a|pdf|webp|heic|docx?|xlsx?|zip)"
+    r"|[A-Za-z0-9_-]+-\d{8}-WA\d+\.[A-Za-z0-9]{1,5})",
+    re.IGNORECASE
+)
+_ATTACH_DATE_FROM_NAME_RE = re.compile(r".*-(\d{8})-WA\d+\.[A-Za-z0-9]{1,5}$")
+# "Média omis" & co. : une seule recherche insensible à la casse au lieu d'un test par jeton
+_OMITTED_RE = re.compile("|".join(re.escape(t) for t in sorted(MEDIA_OMITTED_TOKENS)), re.IGNORECASE)
 
-def parse_datetime(date_str: str, time_str: str) -> Optional[dt.datetime]:
-    # Normalise séparateurs et espaces (NBSP, NNBSP)
-    d_norm = re.sub(r"[.\-]", "/", date_str).replace("\u00a0", " ").replace("\u202f", " ").strip()
-    t_norm = time_str.replace("\u00a0", " ").replace("\u202f", " ").strip().upper()
+def classify_ext(path: Path) -> str:
+    return _EXT_TO_KIND.get(path.suffix.lower(), "doc")
 
+def _parse_datetime_slow(d_norm: str, t_norm: str) -> Optional[dt.datetime]:
     fmts = [
         # 24h
         "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M",
@@ -122,136 +154,287 @@ def parse_datetime(date_str: str, time_str: str) -> Optional[dt.datetime]:
             continue
     return None
 
-def detect_txt_file(extract_dir: Path) -> Optional[Path]:
-    txts = list(extract_dir.glob("*.txt")) + list(extract_dir.glob("**/*.txt"))
-    if not txts:
-        return None
-    txts.sort(key=lambda p: p.stat().st_size if p.exists() else 0, reverse=True)
-    return txts[0]
+def parse_datetime(date_str: str, time_str: str, fmt_hint: str = "%d/%m/%Y %H:%M:%S") -> Optional[dt.datetime]:
+    """fmt_hint : format de la branche regex qui a matché (ordre jour/mois, 12h/24h)."""
+    # Normalise séparateurs et espaces (NBSP, NNBSP)
+    # (str.replace ne copie rien quand le caractère est absent : plus rapide que re.sub ou str.translate)
+    d_norm = date_str.replace(".", "/").replace("-", "/").replace("\u00a0", " ").replace("\u202f", " ").strip()
+    t_norm = time_str.replace("\u00a0", " ").replace("\u202f", " ").strip().upper()
+
+    # Chemin rapide : découpage manuel + constructeur datetime, sans strptime
+    try:
+        a, b, y = d_norm.split("/")
+        ampm = t_norm[-2:] if t_norm.endswith(("AM", "PM")) else ""
+        hms = t_norm[:-2].rstrip() if ampm else t_norm
+        hh, mi, *ss = hms.split(":")
+        if len(y) == 4:
+            year = int(y)
+        elif len(y) == 2:
+            year = int(y)
+            year += 1900 if year >= 69 else 2000  # même pivot que %y
+        else:
+            raise ValueError(y)
+        hour, minute, second = int(hh), int(mi), int(ss[0]) if ss else 0
+        if ampm or "%p" in fmt_hint:
+            if not ampm or not 1 <= hour <= 12:
+                raise ValueError(t_norm)
+            hour = hour % 12 + (12 if ampm == "PM" else 0)
+        day_month = ((int(a), int(b)), (int(b), int(a)))
+        if fmt_hint.startswith("%m"):
+            day_month = day_month[::-1]
+        for day, month in day_month:
+            try:
+                return dt.datetime(year, month, day, hour, minute, second)
+            except ValueError:
+                continue
+    except ValueError:
+        pass
+    # Dernier recours : essais strptime successifs
+    return _parse_datetime_slow(d_norm, t_norm)
 
 def detect_title_from_txtname(txt_path: Path) -> str:
     name = txt_path.stem
-    name = re.sub(r"^WhatsApp Chat with\s+", "", name, flags=re.IGNORECASE)
-    name = re.sub(r"^Discussion WhatsApp avec\s+", "", name, flags=re.IGNORECASE)
+    for rx in _TITLE_PREFIX_RES:
+        name = rx.sub("", name)
     name = name.replace("_", " ")
     return name or "WhatsApp Chat"
 
+# __slots__ : pas de __dict__ par instance (des dizaines de milliers de messages par discussion)
 class Attachment:
+    __slots__ = ("relpath", "kind", "filename")
+
     def __init__(self, relpath: str, kind: str, filename: str):
         self.relpath = relpath
         self.kind = kind
         self.filename = filename
 
 class Message:
+    __slots__ = ("timestamp", "author", "text", "attachments")
+
     def __init__(self, ts: dt.datetime, author: str, text: str):
         self.timestamp = ts
         self.author = author
         self.text = text
         self.attachments: List[Attachment] = []
 
+def zip_member_relpath(name: str, base: str) -> Optional[str]:
+    """Chemin relatif où ZipFile.extract écrit le membre `name` sous base (même nettoyage :
+    séparateurs, lecteur, composants vides/./..), ou None si le nom normalisé sort de base
+    (../, chemin absolu) : un tel membre est ignoré."""
+    local = name.replace("/", os.sep)
+    if os.altsep:
+        local = local.replace(os.altsep, os.sep)
+    base = os.path.abspath(base)
+    if os.path.commonpath([base, os.path.abspath(os.path.join(base, local))]) != base:
+        return None
+    local = os.path.splitdrive(local)[1]
+    parts = [part for part in local.split(os.sep) if part not in ("", os.curdir, os.pardir)]
+    return os.sep.join(parts) or None
+
+class Archive:
+    """Zip d'un upload et ses fichiers, indexés par leur chemin d'extraction sous base_dir."""
+    def __init__(self, z: zipfile.ZipFile, base_dir: str):
+        self.zip = z
+        self.members: Dict[str, zipfile.ZipInfo] = {}
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            relpath = zip_member_relpath(info.filename, base_dir)
+            if relpath is not None:
+                self.members[relpath] = info
+
 class Conversation:
-    def __init__(self, chat_id: str, title: str, messages: List[Message], base_dir: Path):
+    def __init__(self, chat_id: str, title: str, messages: List[Message], base_dir: Path,
+                 archive: Optional[Archive] = None):
         self.chat_id = chat_id
         self.title = title
         self.messages = messages
         self.base_dir = base_dir
+        self.archive = archive  # zip d'origine : médias extraits à la demande (voir media_path)
+
+def detect_encoding(txt_path: Path) -> str:
+    """Encodage d'après le BOM (UTF-16 sur certains exports Android), UTF-8 sinon."""
+    with open(txt_path, "rb") as fh:
+        head = fh.read(3)
+    if head[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return "utf-16"
+    if head == b"\xef\xbb\xbf":
+        return "utf-8-sig"
+    return "utf-8"
+
+def specialize_line_re(m: "re.Match") -> Tuple["re.Pattern", str]:
+    """Regex de la branche de LINE_RE qui a matché, figée sur le séparateur de date et la
+    largeur d'année de cette ligne (un export n'utilise qu'un format). Groupe externe unique :
+    m.lastindex == 1, puis (date, heure, auteur, texte) comme pour LINE_RE."""
+    k = m.lastindex
+    pat, _fmt = DATE_TIME_PATTERNS[int(m.lastgroup[1:])]
+    date_part = m.group(k + 1)
+    sep = next(c for c in date_part if not c.isdigit())
+    year = date_part.rsplit(sep, 1)[1]
+    src = pat.pattern[1:].replace(r"[\/\.\-]", re.escape(sep)).replace(r"\d{2,4}", r"\d{%d}" % len(year))
+    return re.compile(f"(?P<f>{src})"), LINE_FMTS[k]
 
 def parse_chat_text(txt_path: Path) -> Tuple[str, List[Message]]:
-    data = None
-    for enc in ("utf-8-sig", "utf-16", "utf-8"):
-        try:
-            data = txt_path.read_text(encoding=enc)
-            break
-        except Exception:
-            continue
-    if data is None:
+    try:
+        fh = open(txt_path, "r", encoding=detect_encoding(txt_path), errors="replace")
+    except OSError:
         raise RuntimeError(f"Impossible de lire {txt_path}")
-    lines = data.splitlines()
     messages: List[Message] = []
     current: Optional[Message] = None
     title = detect_title_from_txtname(txt_path)
-
-    for raw in lines:
-        # Normalise LRM + NBSP + NNBSP
-        line = raw.replace("\u200e", "").replace("\u00a0", " ").replace("\u202f", " ").strip()
-        matched = False
-        for pat, _fmt in DATE_TIME_PATTERNS:
-            m = pat.match(line)
-            if m:
-                matched = True
-                date_part, time_part, author, text = m.group(1), m.group(2), m.group(3).strip(), m.group(4)
-                ts = parse_datetime(date_part, time_part) or dt.datetime.now()
+    # Regex spécialisée, construite à la première ligne reconnue ; LINE_RE en repli
+    spec_re: Optional["re.Pattern"] = None
+    spec_fmt = ""
+
+    # Lecture ligne à ligne : pas de copie complète du fichier en mémoire
+    with fh:
+        for raw in fh:
+            # Normalise LRM + NBSP + NNBSP
+            line = raw.replace("\u200e", "").replace("\u00a0", " ").replace("\u202f", " ").strip()
+            # Filtre rapide : une ligne d'en-tête commence toujours par '[' ou un chiffre ;
+            # les lignes de continuation (la majorité) sortent ici sans aucune regex
+            c0 = line[:1]
+            if c0 != "[" and not c0.isdigit():
                 if current:
-                    messages.append(current)
-                current = Message(ts, author, text.strip())
-                break
-        if not matched:
-            if current:
-                current.text += "\n" + line
-            else:
+                    current.text += "\n" + line
                 continue
+            m = spec_re.match(line) if spec_re else None
+            if m:
+                fmt = spec_fmt
+            else:
+                m = LINE_RE.match(line)
+                if not m:
+                    if current:
+                        current.text += "\n" + line
+                    continue
+                fmt = LINE_FMTS[m.lastindex]
+                if spec_re is None:
+                    spec_re, spec_fmt = specialize_line_re(m)
+            k = m.lastindex
+            date_part, time_part, author, text = m.group(k + 1, k + 2, k + 3, k + 4)
+            ts = parse_datetime(date_part, time_part, fmt) or dt.datetime.now()
+            if current:
+                messages.append(current)
+            # les auteurs se répètent : une seule chaîne partagée par auteur
+            current = Message(ts, sys.intern(author.strip()), text.strip())
     if current:
         messages.append(current)
     messages.sort(key=lambda m: m.timestamp)
     return title, messages
 
-def link_attachments(conv: Conversation) -> None:
-    """Associer heuristiquement les fichiers médias aux messages."""
-    media_files: Dict[str, Path] = {}
-    for p in conv.base_dir.rglob("*"):
-        if p.is_file() and p.suffix.lower() in ALL_MEDIA_EXTS:
-            media_files[p.name] = p
-    assigned = {k: False for k in media_files.keys()}
-
-    # Regex sûres (pas de 'bad character range')
-    filename_pat = re.compile(r"([A-Za-z0-9_-]+-\d{8}-WA\d+\.[A-Za-z0-9]{1,5})")
-    generic_file_pat = re.compile(
-        r"([\w.\-]+\.(?:jpg|jpeg|png|gif|mp4|3gp|mov|avi|mkv|m4v|opus|ogg|mp3|wav|m4a|pdf|webp|heic|docx?|xlsx?|zip))",
-        re.IGNORECASE
-    )
-    date_from_name = re.compile(r".*-(\d{8})-WA\d+\.[A-Za-z0-9]{1,5}$")
-
+def zip_media(archive: Archive, root: str):
+    """(nom, chemin d'extraction) de chaque fichier média du zip, d'après son sommaire (rien n'est extrait)."""
+    for relpath in archive.members:
+        name = os.path.basename(relpath)
+        if os.path.splitext(name)[1].lower() in ALL_MEDIA_EXTS:
+            yield name, os.path.join(root, relpath)
+
+def regex_names_in(text: str):
+    return {m.group(1) for m in _ATTACH_RE.finditer(text)}
+
+def make_name_finder(known_names):
+    """Fonction texte -> noms de fichiers cités. Avec pyahocorasick : un automate sur les noms
+    connus (un seul passage en C par message) ; sinon la regex _ATTACH_RE."""
+    if ahocorasick is None:
+        return regex_names_in
+    automaton = ahocorasick.Automaton()
+    for name in known_names:
+        # mêmes noms que ceux que la regex saurait extraire
+        if _ATTACH_RE.fullmatch(name):
+            automaton.add_word(name, name)
+    if not len(automaton):
+        return lambda text: ()
+    automaton.make_automaton()
+
+    def names_in(text: str):
+        found = {}
+        for end, name in automaton.iter(text):
+            start = end - len(name) + 1
+            # début de mot comme pour la regex : "a.jpg" n'est pas cité dans "data.jpg"
+            if start > 0 and (text[start - 1].isalnum() or text[start - 1] in "_.-"):
+                continue
+            # fin du nom là où la regex l'arrêterait : "photo.jpg" n'est pas cité dans
+            # "photo.jpg.png" (un nom inclus dans un nom plus long est écarté)
+            m = _ATTACH_RE.match(text, start)
+            if m is None or m.end() != end + 1:
+                continue
+            found[name] = None
+        return found
+    return names_in
+
+def link_attachments(conv: Conversation, media) -> None:
+    """Associer heuristiquement les fichiers médias aux messages.
+    media : itérable de (nom, chemin sous conv.base_dir), voir zip_media."""
+    # Tableaux parallèles de chaînes (pas d'objets Path) ; un octet "assigné" par fichier
+    base = str(conv.base_dir)
+    names: List[str] = []
+    paths: List[str] = []
+    name_to_idx: Dict[str, int] = {}
+    for name, path in media:
+        name_to_idx[name] = len(paths)
+        names.append(name)
+        paths.append(path)
+    assigned = bytearray(len(paths))
+
+    def attach(msg: Message, idx: int):
+        fname = names[idx]
+        msg.attachments.append(Attachment(os.path.relpath(paths[idx], base), classify_ext(Path(fname)), fname))
+        assigned[idx] = 1
+
+    names_in = make_name_finder(name_to_idx)
     for msg in conv.messages:
-        files_in_text = set()
-        for rx in (filename_pat, generic_file_pat):
-            for m in rx.finditer(msg.text):
-                files_in_text.add(m.group(1))
-        for fname in files_in_text:
-            p = media_files.get(fname)
-            if p and not assigned[fname]:
-                msg.attachments.append(Attachment(str(p.relative_to(conv.base_dir)), classify_ext(p), fname))
-                assigned[fname] = True
-
-    # Heuristique par date si le nom ressemble à ...-YYYYMMDD-...
+        for fname in names_in(msg.text):
+            idx = name_to_idx.get(fname)
+            if idx is not None and not assigned[idx]:
+                attach(msg, idx)
+
+    # Heuristique par date si le nom ressemble à ...-YYYYMMDD-... :
+    # index date -> fichiers encore libres, construit une seule fois
+    by_date: Dict[dt.date, List[int]] = {}
+    for fname, idx in name_to_idx.items():
+        if assigned[idx]:
+            continue
+        m = _ATTACH_DATE_FROM_NAME_RE.match(fname)
+        if not m:
+            continue
+        ymd = m.group(1)
+        try:
+            d = dt.date(int(ymd[:4]), int(ymd[4:6]), int(ymd[6:8]))
+        except ValueError:
+            continue
+        by_date.setdefault(d, []).append(idx)
+    for bucket in by_date.values():
+        bucket.reverse()  # pop() rend le premier fichier rencontré
+    if not by_date:
+        return
     for msg in conv.messages:
         if msg.attachments:
             continue
-        text_l = msg.text.strip().lower()
-        if not text_l or any(tok.lower() in text_l for tok in MEDIA_OMITTED_TOKENS):
-            for fname, p in list(media_files.items()):
-                if assigned.get(fname):
-                    continue
-                m = date_from_name.match(fname)
-                if not m:
-                    continue
-                try:
-                    d = dt.datetime.strptime(m.group(1), "%Y%m%d").date()
-                except Exception:
-                    continue
-                if d == msg.timestamp.date():
-                    msg.attachments.append(Attachment(str(p.relative_to(conv.base_dir)), classify_ext(p), fname))
-                    assigned[fname] = True
-                    break
+        if not msg.text.strip() or _OMITTED_RE.search(msg.text):
+            bucket = by_date.get(msg.timestamp.date())
+            if bucket:
+                attach(msg, bucket.pop())
 
 def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
+def media_path(conv: Conversation, relpath: str) -> Path:
+    """Chemin local d'un média, extrait du zip à la première demande."""
+    p = conv.base_dir / relpath
+    if conv.archive is not None and not p.exists():
+        info = conv.archive.members.get(relpath)
+        if info is not None:
+            try:
+                return Path(conv.archive.zip.extract(info, conv.base_dir))
+            except (OSError, zipfile.BadZipFile):
+                pass
+    return p
+
 def safe_slug(s: str) -> str:
-    import re as _re
-    slug = _re.sub(r"[^a-zA-Z0-9_-]+", "_", s.strip())
+    slug = _SLUG_RE.sub("_", s.strip())
     return slug[:80] if slug else "chat"
 
-def b64_image(path: Path) -> Optional[str]:
+def encode_image(path: Path) -> Optional[str]:
     try:
         mime = {
             ".jpg":"image/jpeg",".jpeg":"image/jpeg",".png":"image/png",".gif":"image/gif",".webp":"image/webp",".heic":"image/heic"
@@ -261,35 +444,57 @@ def b64_image(path: Path) -> Optional[str]:
     except Exception:
         return None
 
-def render_chat_html(conv: Conversation, me_names: List[str], show_author: bool) -> str:
+@st.cache_data(max_entries=500, show_spinner=False)
+def _b64_image_cached(path_str: str, mtime_ns: int, size: int) -> Optional[str]:
+    return encode_image(Path(path_str))
+
+def b64_image(path: Path) -> Optional[str]:
+    """encode_image mémorisé par (chemin, mtime, taille), partagé entre reruns et sessions."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return _b64_image_cached(str(path), stat.st_mtime_ns, stat.st_size)
+
+# Fragments HTML du rendu, préparés une fois (formatage % dans la boucle)
+_BUBBLE_OPEN = {True: '<div class="msg right">', False: '<div class="msg left">'}
+_AUTHOR_TPL = '<div class="author">%s</div>'
+_LINE_TPL = '<div>%s</div>'
+_IMG_TPL = '<img class="media" src="%s" alt="%s">'
+_DOC_TPLS = {
+    "image": '<div class="doc">🖼 %s</div>',
+    "video": '<div class="doc">🎞 %s</div>',
+    "audio": '<div class="doc">🔊 %s</div>',
+}
+_DOC_TPL_DEFAULT = '<div class="doc">📎 %s</div>'
+_META_CLOSE_TPL = '<div class="meta">%s</div></div>'
+
+def render_chat_html(conv: Conversation, me_names: List[str], show_author: bool,
+                     messages: Optional[List[Message]] = None) -> str:
+    """messages : fenêtre à afficher (toute la conversation par défaut) ; seules
+    ses images sont encodées en base64."""
+    esc = html.escape
+    me_set = set(me_names)
     html_parts = []
-    html_parts.append(f'<div class="header">{conv.title}<span class="badge">Pour Manon</span></div>')
-    html_parts.append('<div class="container"><div class="bubbles">')
-    for m in conv.messages:
-        side = "right" if m.author in me_names else "left"
-        bubble = [f'<div class="msg {side}">']
+    append = html_parts.append
+    append('<div class="header">%s<span class="badge">Pour Manon</span></div>' % esc(conv.title))
+    append('<div class="container"><div class="bubbles">')
+    for m in (conv.messages if messages is None else messages):
+        append(_BUBBLE_OPEN[m.author in me_set])
         if show_author:
-            bubble.append(f'<div class="author">{m.author}</div>')
-        for line in m.text.split("\\n"):
-            bubble.append(f"<div>{line}</div>")
+            append(_AUTHOR_TPL % esc(m.author))
+        for line in m.text.split("\n"):
+            append(_LINE_TPL % esc(line))
         for a in m.attachments:
-            p = conv.base_dir / a.relpath
+            fname = esc(a.filename)
             if a.kind == "image":
-                src = b64_image(p)
+                src = b64_image(media_path(conv, a.relpath))
                 if src:
-                    bubble.append(f'<img class="media" src="{src}" alt="{a.filename}">')
-                else:
-                    bubble.append(f'<div class="doc">🖼 {a.filename}</div>')
-            elif a.kind == "video":
-                bubble.append(f'<div class="doc">🎞 {a.filename}</div>')
-            elif a.kind == "audio":
-                bubble.append(f'<div class="doc">🔊 {a.filename}</div>')
-            else:
-                bubble.append(f'<div class="doc">📎 {a.filename}</div>')
-        bubble.append(f'<div class="meta">{m.timestamp.strftime("%d/%m/%Y %H:%M")}</div>')
-        bubble.append("</div>")
-        html_parts.append("".join(bubble))
-    html_parts.append("</div></div>")
+                    append(_IMG_TPL % (src, fname))
+                    continue
+            append(_DOC_TPLS.get(a.kind, _DOC_TPL_DEFAULT) % fname)
+        append(_META_CLOSE_TPL % m.timestamp.strftime("%d/%m/%Y %H:%M"))
+    append("</div></div>")
     return "".join(html_parts)
 
 # --- Sidebar (upload + options)
@@ -302,40 +507,79 @@ st.sidebar.markdown('<span class="sidebar-note">Astuce: exporte la discussion av
 root = Path(st.session_state.get("wa_root", str(Path.home() / ".wa_streamlit")))
 ensure_dir(root)
 
-def load_zip(upload_file) -> Optional["Conversation"]:
-    stamp = dt.datetime.now().strftime("%Y%m%d%H%M%S%f")
-    extract_dir = root / f"upload_{stamp}"
-    ensure_dir(extract_dir)
-    data = upload_file.read()
+# Les zips sont identifiés par le hash de leur contenu : un rerun Streamlit (clic, toggle...)
+# ou un ré-upload du même fichier ne ré-ouvre et ne re-parse rien.
+@st.cache_resource(show_spinner=False, max_entries=16)
+def open_zip(digest: str, _data: bytes, root_dir: str) -> Optional[Tuple[Archive, str, Optional[str]]]:
+    """(zip ouvert, dossier d'extraction, .txt extrait). Le zip est copié une fois sur disque
+    et ouvert par chemin : seul son sommaire reste en mémoire. Du contenu, seul le .txt de
+    la discussion (le plus gros) est extrait ; les médias le sont à la demande (media_path)."""
+    zip_path = Path(root_dir) / f"upload_{digest}.zip"
+    if not zip_path.exists():
+        part = zip_path.with_suffix(".part")
+        part.write_bytes(_data)
+        os.replace(part, zip_path)
     try:
-        with zipfile.ZipFile(io.BytesIO(data), "r") as z:
-            z.extractall(extract_dir)
+        z = zipfile.ZipFile(zip_path, "r")
     except zipfile.BadZipFile:
+        zip_path.unlink(missing_ok=True)
+        return None
+    extract_dir = Path(root_dir) / f"upload_{digest}"
+    ensure_dir(extract_dir)
+    archive = Archive(z, str(extract_dir))
+    txts = [i for i in archive.members.values() if i.filename.lower().endswith(".txt")]
+    if not txts:
+        return archive, str(extract_dir), None
+    best = max(txts, key=lambda i: i.file_size)
+    return archive, str(extract_dir), z.extract(best, extract_dir)
+
+@st.cache_data(show_spinner=False)
+def parse_archive(digest: str, extract_dir: str, txt_path: str, _archive: Archive) -> Tuple[str, list]:
+    """(titre, [(ts, auteur, texte, [(relpath, kind, filename), ...]), ...]) : types simples, picklables."""
+    title, messages = parse_chat_text(Path(txt_path))
+    conv = Conversation(chat_id=safe_slug(title), title=title, messages=messages, base_dir=Path(extract_dir))
+    link_attachments(conv, zip_media(_archive, extract_dir))
+    rows = [(m.timestamp, m.author, m.text, [(a.relpath, a.kind, a.filename) for a in m.attachments])
+            for m in messages]
+    return title, rows
+
+def load_zip(upload_file) -> Optional["Conversation"]:
+    data = upload_file.getvalue()
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    opened = open_zip(digest, data, str(root))
+    if opened is None:
         st.warning(f"ZIP invalide: {upload_file.name}")
         return None
-    txt_path = detect_txt_file(extract_dir)
-    if not txt_path:
+    archive, extract_dir, txt_path = opened
+    if txt_path is None:
         st.warning(f"Aucun .txt trouvé dans {upload_file.name}")
         return None
-    title, messages = parse_chat_text(txt_path)
-    conv = Conversation(chat_id=safe_slug(title), title=title, messages=messages, base_dir=extract_dir)
-    link_attachments(conv)
-    return conv
+    title, rows = parse_archive(digest, extract_dir, txt_path, archive)
+    messages = []
+    for ts, author, text, atts in rows:
+        msg = Message(ts, author, text)
+        msg.attachments = [Attachment(*a) for a in atts]
+        messages.append(msg)
+    return Conversation(chat_id=safe_slug(title), title=title, messages=messages,
+                        base_dir=Path(extract_dir), archive=archive)
 
 # --- Header
 st.markdown(f'<div class="header">Conversations WhatsApp <span class="badge">Pour Manon</span></div>', unsafe_allow_html=True)
 
 # --- Load conversations
 convs: Dict[str, Conversation] = {}
+parts: Dict[str, List[List[Message]]] = {}  # messages (déjà triés) de chaque zip, par discussion
 if uploaded:
     for uf in uploaded:
         conv = load_zip(uf)
         if conv:
-            if conv.chat_id in convs:
-                convs[conv.chat_id].messages.extend(conv.messages)
-                convs[conv.chat_id].messages.sort(key=lambda m: m.timestamp)
-            else:
+            if conv.chat_id not in convs:
                 convs[conv.chat_id] = conv
+            parts.setdefault(conv.chat_id, []).append(conv.messages)
+# Plusieurs exports d'une même discussion : fusion des listes triées en un seul passage
+for cid, lists in parts.items():
+    if len(lists) > 1:
+        convs[cid].messages = list(heapq.merge(*lists, key=lambda m: m.timestamp))
 
 if not convs:
     st.info("Dépose tes .zip ici pour commencer. Le viewer reconstruira la conversation avec un look WhatsApp ✨.")
@@ -347,9 +591,9 @@ for cid, c in convs.items():
     if c.messages:
         first = c.messages[0].timestamp.strftime("%d/%m/%Y")
         last = c.messages[-1].timestamp.strftime("%d/%m/%Y")
-        items.append((cid, f"{c.title} — {len(c.messages)} msgs — {first} → {last}"))
+        items.append((cid, f"{c.title} — {len(c.messages)} msgs — {first} → {last}", c.messages[-1].timestamp))
 
-items.sort(key=lambda t: convs[t[0]].messages[-1].timestamp if convs[t[0]].messages else dt.datetime.min, reverse=True)
+items.sort(key=operator.itemgetter(2), reverse=True)
 
 if not items:
     st.warning("Aucune discussion avec des messages exploitables n'a été trouvée dans tes .zip. Vérifie l'export (inclure les médias) et réessaie.")
@@ -357,7 +601,7 @@ if not items:
         st.caption("Conversations détectées : " + ", ".join(sorted([c.title for c in convs.values()])))
     st.stop()
 
-labels = [lbl for _, lbl in items]
+labels = [lbl for _, lbl, _ in items]
 choice = st.sidebar.selectbox("Choisis une discussion", options=list(range(len(items))), index=0,
                               format_func=lambda i: labels[i] if 0 <= i < len(labels) else "")
 sel_cid = items[int(choice)][0]
@@ -370,58 +614,89 @@ with c1:
     show_author = st.toggle("Afficher l'auteur", value=show_author_default)
 with c2:
     export_pdf_click = st.button("📄 Exporter en PDF")
+with c3:
+    page_size = int(st.number_input("Messages par page", min_value=50, max_value=5000, value=200, step=50))
+
+# --- Pagination : seule la fenêtre affichée est rendue (et ses images encodées)
+n_msgs = len(conv.messages)
+max_offset = max(0, n_msgs - page_size)
+offset = 0
+if max_offset:
+    offset = st.slider("Position dans la discussion", min_value=0, max_value=max_offset, value=max_offset)
+msgs_slice = conv.messages[offset:offset + page_size]
+st.caption(f"Messages {offset + 1}–{offset + len(msgs_slice)} sur {n_msgs}")
 
 # --- Render
 me_names = [me_name.strip()] if me_name.strip() else []
 me_names += ["You", "Vous", "Moi"]
-html_chat = render_chat_html(conv, me_names=me_names, show_author=show_author)
+html_chat = render_chat_html(conv, me_names=me_names, show_author=show_author, messages=msgs_slice)
 st.markdown(html_chat, unsafe_allow_html=True)
 
 # --- PDF export
+_PDF_TPL_SRC = """
+<!doctype html><html><head><meta charset="utf-8">
+<style>{{ css | safe }} body{background:white}.container{background:white}.msg{box-shadow:none}</style>
+</head><body>
+<div class="header">{{ title }} <span class="badge">Pour Manon</span></div>
+<div class="container"><div class="bubbles">
+{% for m in rows %}
+  <div class="msg {{ m.side }}">
+    {% if show_author %}<div class="author">{{ m.author }}</div>{% endif %}
+    {% for line in m.lines %}<div>{{ line }}</div>{% endfor %}
+    {% for is_image, value in m.attachments %}
+      {% if is_image %}<img class="media" src="{{ value }}" />{% else %}<div class="doc">{{ value }}</div>{% endif %}
+    {% endfor %}
+    <div class="meta">{{ m.meta }}</div>
+  </div>
+{% endfor %}
+</div></div></body></html>
+"""
+_PDF_CSS = BASE_CSS.replace("<style>", "").replace("</style>", "")
+_PDF_DOC_ICONS = {"video": "🎞", "audio": "🔊"}
+
+@st.cache_resource(show_spinner=False)
+def pdf_template():
+    """Template Jinja du PDF, compilé une fois par processus (et non à chaque export ou rerun)."""
+    from jinja2 import BaseLoader, Environment
+    return Environment(loader=BaseLoader(), autoescape=True).from_string(_PDF_TPL_SRC)
+
 def export_pdf(conv: Conversation, me_names: List[str]) -> Optional[Path]:
+    # Les deux moteurs lisent les images sur disque : les extraire du zip si besoin
+    for m in conv.messages:
+        for a in m.attachments:
+            if a.kind == "image":
+                media_path(conv, a.relpath)
+    me_set = set(me_names)
     try:
-        from jinja2 import Template
         from weasyprint import HTML
-        pdf_tpl = """
-        <!doctype html><html><head><meta charset="utf-8">
-        <style>{{ css }} body{background:white}.container{background:white}.msg{box-shadow:none}</style>
-        </head><body>
-        <div class="header">{{ conv.title }} <span class="badge">Pour Manon</span></div>
-        <div class="container"><div class="bubbles">
-        {% for m in conv.messages %}
-          <div class="msg {{ 'right' if m.author in me_names else 'left' }}">
-            {% if show_author %}<div class="author">{{ m.author }}</div>{% endif %}
-            {% for line in m.text.split('\\n') %}<div>{{ line }}</div>{% endfor %}
-            {% for a in m.attachments %}
-              {% if a.kind == 'image' %}
-                <img class="media" src="{{ base }}/{{ a.relpath }}" />
-              {% elif a.kind == 'video' %}
-                <div class="doc">🎞 {{ a.filename }}</div>
-              {% elif a.kind == 'audio' %}
-                <div class="doc">🔊 {{ a.filename }}</div>
-              {% else %}
-                <div class="doc">📎 {{ a.filename }}</div>
-              {% endif %}
-            {% endfor %}
-            <div class="meta">{{ m.timestamp.strftime("%d/%m/%Y %H:%M") }}</div>
-          </div>
-        {% endfor %}
-        </div></div></body></html>
-        """
-        tpl = Template(pdf_tpl)
-        html_str = tpl.render(conv=conv, css=BASE_CSS, me_names=me_names,
-                              show_author=(len({m.author for m in conv.messages})>2), base=str(conv.base_dir))
+        tpl = pdf_template()
+        # Messages pré-sérialisés : le template ne fait que des accès à des dicts
+        base = str(conv.base_dir)
+        rows = [{
+            "side": "right" if m.author in me_set else "left",
+            "author": m.author,
+            "lines": m.text.split("\n"),
+            "attachments": [(True, f"{base}/{a.relpath}") if a.kind == "image"
+                            else (False, f"{_PDF_DOC_ICONS.get(a.kind, '📎')} {a.filename}")
+                            for a in m.attachments],
+            "meta": m.timestamp.strftime("%d/%m/%Y %H:%M"),
+        } for m in conv.messages]
+        html_str = tpl.render(rows=rows, title=conv.title, css=_PDF_CSS,
+                              show_author=(len({m.author for m in conv.messages})>2))
         out_dir = Path(root) / "pdf_exports"; ensure_dir(out_dir)
         out_pdf = out_dir / f"{safe_slug(conv.title)}.pdf"
-        HTML(string=html_str, base_url=str(conv.base_dir)).write_pdf(str(out_pdf))
+        HTML(string=html_str, base_url=base).write_pdf(str(out_pdf))
         return out_pdf
     except Exception:
         pass
     try:
+        from reportlab.lib.enums import TA_LEFT, TA_RIGHT
         from reportlab.lib.pagesizes import A4
+        from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
         from reportlab.lib.units import mm
-        from reportlab.pdfgen import canvas as rl_canvas
         from reportlab.lib.utils import ImageReader
+        from reportlab.pdfgen import canvas as rl_canvas
+        from reportlab.platypus import Paragraph, Frame
         width, height = A4
         out_dir = Path(root) / "pdf_exports"; ensure_dir(out_dir)
         out_pdf = out_dir / f"{safe_slug(conv.title)}.pdf"
@@ -429,16 +704,15 @@ def export_pdf(conv: Conversation, me_names: List[str]) -> Optional[Path]:
         margin = 15 * mm
         max_w = width - 2*margin
         y = height - margin
-        me_set = set(me_names)
+        # Deux styles (gauche / droite) créés une fois pour tout le document
+        normal = getSampleStyleSheet()['Normal']
+        styles = {right: ParagraphStyle('bubble', parent=normal, alignment=TA_RIGHT if right else TA_LEFT,
+                                        fontSize=9, leading=11)
+                  for right in (False, True)}
         def draw_text(text, right=False):
             nonlocal y
-            from reportlab.lib.styles import getSampleStyleSheet
-            from reportlab.platypus import Paragraph, Frame
-            from reportlab.lib.enums import TA_LEFT, TA_RIGHT
-            from reportlab.lib.styles import ParagraphStyle
-            style = ParagraphStyle('bubble', parent=getSampleStyleSheet()['Normal'],
-                                   alignment=TA_RIGHT if right else TA_LEFT, fontSize=9, leading=11)
-            p = Paragraph(text.replace("\\n","<br/>"), style)
+            # Paragraph interprète du balisage : échapper le texte brut
+            p = Paragraph(html.escape(text).replace("\n", "<br/>"), styles[right])
             w, h = p.wrap(max_w, 10000)
             if y - h < margin: c.showPage(); y = height - margin
             x = width - margin - w if right else margin